@@ -1,119 +1,263 @@
 """Orchestrates the extension analysis process"""
 
+import io
 import os
-import json
-import zipfile
 import shutil
+import functools
+import hashlib
+import zipfile
+import tempfile
+import itertools
 import subprocess
+import multiprocessing
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    Future,
+    FIRST_COMPLETED,
+    wait,
+)
 from datetime import date
+from typing import BinaryIO, Dict, Iterable, Iterator, List, NamedTuple, Tuple
 from logging import Logger
 from dotenv import load_dotenv
+import ijson
+import orjson
 import pandas as pd
 from botocore.client import BaseClient
+from botocore.exceptions import BotoCoreError, ClientError
 import boto3
+from boto3.s3.transfer import TransferConfig
 import psycopg2
 
 from setup import configure_logger, setup_db
 from util import (
     connect_to_database,
-    select_extensions,
-    select_publishers,
-    select_releases,
-    combine_dataframes,
-    select_analyses,
-    upsert_data,
+    release_connection,
+    select_pending_releases,
+    prepare_select_cached_analysis,
+    select_cached_analysis,
+    copy_upsert_data,
 )
 
+# Each analysis process downloads, audits and scans its own batch
+ANALYSIS_PROCESSES = os.cpu_count() or 1
+DOWNLOAD_WORKERS = 4
+PREFETCH_LIMIT = 2 * DOWNLOAD_WORKERS
+SEMGREP_BATCH_SIZE = 50
+SEMGREP_JOBS = max(1, (os.cpu_count() or 1) // ANALYSIS_PROCESSES)
+AUDIT_WORKERS = 4
+
+# Analysis fields derived from the .vsix file contents alone
+PAYLOAD_COLUMNS = [
+    "dependencies",
+    "activation_events",
+    "semgrep_detections",
+    "npm_audit_vulnerabilities",
+]
+ANALYSES_COLUMNS = ["analysis_id", "release_id", "insertion_date"] + PAYLOAD_COLUMNS
+
+# Rules that semgrep scans the extracted sources with
+SEMGREP_CONFIG_FOLDER = "semgrep"
+
+# npm's metadata cache persists across runs so resolution stays warm
+NPM_CACHE_FOLDER = os.path.abspath("extensions/.npm-cache")
+
+# Parsed npm audit results, keyed by the hash of the audited dependencies
+AUDIT_CACHE: Dict[str, dict] = {}
+
+# Large .vsix files are fetched as parallel ranged GETs
+VSIX_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    io_chunksize=256 * 1024,
+    use_threads=True,
+)
 
-def download_vsix_file(logger: Logger, s3_client: BaseClient, object_key: str) -> None:
-    """Downloads the S3 object associated with the given key"""
 
-    bucket_name = os.getenv("S3_BUCKET_NAME")
+class Release(NamedTuple):
+    """Identifies a release to analyze and the location of its .vsix file"""
 
-    destination_folder = "extensions/vsix"
-    os.makedirs(destination_folder, exist_ok=True)
-    destination_path = os.path.join(destination_folder, object_key.replace("/", "-"))
+    release_id: str
+    publisher_name: str
+    extension_name: str
+    version: str
 
-    s3_client.download_file(bucket_name, object_key, destination_path)
-    logger.info("download_vsix_file: dowloaded S3 object %s", object_key)
 
+def dumps_json(value) -> str:
+    """Serializes the given value to a JSON string"""
 
-def unzip_vsix_file(logger: Logger, object_key: str) -> None:
-    """Unzips the .vsix extension file"""
+    return orjson.dumps(value).decode("utf-8")
 
-    destination_path = "extensions/vsix/" + object_key.replace("/", "-")
-    destination_folder = "extensions/unzipped"
 
-    if zipfile.is_zipfile(destination_path):
-        unzip_folder = os.path.join(destination_folder, os.path.splitext(object_key)[0])
-        os.makedirs(unzip_folder, exist_ok=True)
-        with zipfile.ZipFile(destination_path, "r") as zip_ref:
-            zip_ref.extractall(unzip_folder)
-            logger.info(
-                "unzip_vsix_file: unzipped .vsix file into %s", destination_path
-            )
+def get_scratch_root() -> str:
+    """Returns the folder that holds per-batch scratch files"""
 
+    return os.getenv("SCRATCH_ROOT") or tempfile.gettempdir()
 
-def find_package_json(logger: Logger, object_key: str) -> dict:
-    """Retrieves the package.json file data"""
 
-    folder_path = "extensions/unzipped/" + object_key.replace(".vsix", "")
-    package_data = None
+def get_object_key(row: Release) -> str:
+    """Builds the S3 object key of the given release"""
 
-    for root, _, files in os.walk(folder_path):
-        if "package.json" in files:
-            package_json_path = os.path.join(root, "package.json")
-            with open(package_json_path, "r", encoding="utf-8") as file:
-                package_data = json.load(file)
-                return package_data
+    publisher_name = row.publisher_name
+    extension_name = row.extension_name
+    release_version = row.version
 
-    logger.error(
-        "find_package_json: failed to find package.json file in %s", folder_path
-    )
-    return package_data
+    return f"extensions/{publisher_name}/{extension_name}/{release_version}.vsix"
 
 
-def extract_package_metadata(package_json: dict) -> dict:
-    """Extracts relevant package.json metadata"""
+def download_vsix_file(
+    logger: Logger, s3_client: BaseClient, object_key: str
+) -> io.BytesIO:
+    """Downloads the S3 object associated with the given key into memory"""
 
-    return {
-        "dependencies": package_json.get("dependencies", {}),
-        "activation_events": package_json.get("activationEvents", []),
-    }
+    bucket_name = os.getenv("S3_BUCKET_NAME")
 
+    vsix_file = io.BytesIO()
+    s3_client.download_fileobj(
+        bucket_name, object_key, vsix_file, Config=VSIX_TRANSFER_CONFIG
+    )
+    vsix_file.seek(0)
+    logger.info("download_vsix_file: dowloaded S3 object %s", object_key)
+    return vsix_file
 
-def semgrep_analysis(logger: Logger) -> dict:
-    """Performs static code analysis using semgrep"""
 
+def prefetch_vsix_files(
+    logger: Logger, s3_client: BaseClient, rows: Iterable[Release]
+) -> Iterator[Tuple[Release, io.BytesIO]]:
+    """Downloads the .vsix files of the given releases concurrently"""
+
+    # Files are yielded as they land, with at most PREFETCH_LIMIT held in memory
+    rows = iter(rows)
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        pending = {}
+        for row in itertools.islice(rows, PREFETCH_LIMIT):
+            future = executor.submit(
+                download_vsix_file, logger, s3_client, get_object_key(row)
+            )
+            pending[future] = row
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                row = pending.pop(future)
+                next_row = next(rows, None)
+                if next_row is not None:
+                    next_future = executor.submit(
+                        download_vsix_file, logger, s3_client, get_object_key(next_row)
+                    )
+                    pending[next_future] = next_row
+
+                # Releases whose download failed stay pending for the next run
+                try:
+                    vsix_file = future.result()
+                except (BotoCoreError, ClientError) as err:
+                    logger.error(
+                        "prefetch_vsix_files: failed to download %s - %s",
+                        get_object_key(row),
+                        str(err),
+                    )
+                    continue
+                yield row, vsix_file
+
+
+def read_package_json_from_vsix(logger: Logger, zip_ref: zipfile.ZipFile) -> dict:
+    """Reads the package.json file data straight from the .vsix archive"""
+
+    # The VSIX layout puts the manifest at a fixed path; only scan the archive's
+    # entries when it is missing
     try:
-        result = subprocess.run(
-            ["semgrep", "--config", "semgrep", "extensions/unzipped", "--json"],
-            text=True,
-            capture_output=True,
-            check=True,
-        )
-        return json.loads(result.stdout)
-    except subprocess.CalledProcessError as err:
-        logger.error("semgrep_analysis: error running semgrep analysis - %s", str(err))
+        package_json_name = zip_ref.getinfo("extension/package.json").filename
+    except KeyError:
+        candidates = [
+            name
+            for name in zip_ref.namelist()
+            if name == "package.json" or name.endswith("/package.json")
+        ]
+        package_json_name = min(candidates, key=len, default=None)
+
+    if package_json_name is not None:
+        package_data = orjson.loads(zip_ref.read(package_json_name))
+        return package_data
+
+    logger.error("read_package_json_from_vsix: failed to find package.json file")
+    return None
+
 
-    return {}
+def unzip_vsix_file(
+    logger: Logger, zip_ref: zipfile.ZipFile, unzip_folder: str
+) -> None:
+    """Unzips the .vsix extension file into the given folder"""
+
+    zip_ref.extractall(unzip_folder)
+    logger.info("unzip_vsix_file: unzipped .vsix file into %s", unzip_folder)
 
 
-def extract_semgrep_metadata(semgrep_output: dict) -> dict:
-    """Extracts relevant semgrep metadata"""
+def extract_package_metadata(package_json: dict) -> dict:
+    """Extracts relevant package.json metadata"""
+
+    return {
+        "dependencies": package_json.get("dependencies", {}),
+        "activation_events": package_json.get("activationEvents", []),
+    }
 
-    semgrep_metadata = {"semgrep_detections": []}
 
-    results = semgrep_output["results"]
-    for result in results:
-        if result["extra"]["message"] not in semgrep_metadata["semgrep_detections"]:
-            semgrep_metadata["semgrep_detections"].append(result["extra"]["message"])
+def semgrep_analysis(
+    logger: Logger, source_folder: str, subfolders: List[str] = None
+) -> dict:
+    """Performs static code analysis on the given folder using semgrep"""
+
+    messages = {}
+    targets = [os.path.join(source_folder, subfolder) for subfolder in subfolders or []]
+
+    with tempfile.TemporaryFile() as stderr_file:
+        with subprocess.Popen(
+            [
+                "semgrep",
+                "--config",
+                SEMGREP_CONFIG_FOLDER,
+                *(targets or [source_folder]),
+                "--json",
+                "--jobs",
+                str(SEMGREP_JOBS),
+            ],
+            stdout=subprocess.PIPE,
+            stderr=stderr_file,
+        ) as process:
+            # Detections are grouped by the top-level subfolder they were found in.
+            # A failed scan returns None, unlike a scan without detections
+            try:
+                for result in ijson.items(process.stdout, "results.item"):
+                    relative_path = os.path.relpath(result["path"], source_folder)
+                    subfolder = relative_path.split(os.sep, 1)[0]
+                    messages.setdefault(subfolder, set()).add(
+                        result["extra"]["message"]
+                    )
+            except ijson.JSONError as err:
+                logger.error(
+                    "semgrep_analysis: error parsing semgrep output - %s", str(err)
+                )
+                process.kill()
+                return None
+
+        if process.returncode != 0:
+            stderr_file.seek(0)
+            logger.error(
+                "semgrep_analysis: error running semgrep analysis - exit status %d: %s",
+                process.returncode,
+                stderr_file.read().decode("utf-8", errors="replace"),
+            )
+            return None
 
-    return semgrep_metadata
+    return {
+        subfolder: {"semgrep_detections": sorted(subfolder_messages)}
+        for subfolder, subfolder_messages in messages.items()
+    }
 
 
-def create_package_json_file(dependencies: dict) -> None:
-    """Creates a temporary package.json file"""
+def create_package_json_file(dependencies: dict, packages_folder: str) -> None:
+    """Creates a temporary package.json file in the given folder"""
 
     package_json = {
         "name": "temp-package",
@@ -122,20 +266,31 @@ def create_package_json_file(dependencies: dict) -> None:
     }
 
     # Ensure the directory exists
-    file_path = "extensions/packages/package.json"
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    os.makedirs(packages_folder, exist_ok=True)
+    file_path = os.path.join(packages_folder, "package.json")
 
-    with open(file_path, "w", encoding="utf-8") as file:
-        json.dump(package_json, file, indent=2)
+    with open(file_path, "wb") as file:
+        file.write(orjson.dumps(package_json, option=orjson.OPT_INDENT_2))
 
 
-def install_package_lock_only(logger: Logger) -> None:
+def npm_environment() -> dict:
+    """Returns the environment for npm subprocesses"""
+
+    return {
+        **os.environ,
+        "NPM_CONFIG_CACHE": NPM_CACHE_FOLDER,
+        "NPM_CONFIG_PREFER_OFFLINE": "true",
+    }
+
+
+def install_package_lock_only(logger: Logger, packages_folder: str) -> bool:
     """Installs dependencies to generate package-lock.json (without installing packages)"""
 
     try:
         subprocess.run(
             ["npm", "install", "--package-lock-only"],
-            cwd="extensions/packages",
+            cwd=packages_folder,
+            env=npm_environment(),
             capture_output=True,
             text=True,
             check=True,
@@ -144,140 +299,354 @@ def install_package_lock_only(logger: Logger) -> None:
         logger.error(
             "install_package_lock_only: error running npm install - %s", str(err)
         )
+        return False
+
+    return True
 
 
-def run_npm_audit(logger: Logger) -> dict:
-    """Runs npm audit"""
+def run_npm_audit(logger: Logger, packages_folder: str) -> dict:
+    """Runs npm audit, returning None if it failed"""
 
+    # npm audit also exits with a non-zero status when it finds vulnerabilities,
+    # so failures are told apart by its output instead
+    result = subprocess.run(
+        ["npm", "audit", "--json"],
+        cwd=packages_folder,
+        env=npm_environment(),
+        capture_output=True,
+        check=False,
+    )
     try:
-        result = subprocess.run(
-            ["npm", "audit", "--json"],
-            cwd="extensions/packages",
-            capture_output=True,
-            text=True,
-            check=True,
+        audit_json = orjson.loads(result.stdout)
+    except orjson.JSONDecodeError as err:
+        logger.error("run_npm_audit: error parsing npm audit output - %s", str(err))
+        return None
+
+    if not isinstance(audit_json, dict) or "error" in audit_json:
+        logger.error(
+            "run_npm_audit: error running npm audit - exit status %d: %s",
+            result.returncode,
+            result.stderr.decode("utf-8", errors="replace"),
         )
-        return json.loads(result.stdout)
-    except subprocess.CalledProcessError as err:
-        logger.error("run_npm_audit: error running npm audit - %s", str(err))
+        return None
 
-    return {}
+    return audit_json
 
 
 def parse_audit_result(audit_json):
     """Parses the npm audit result"""
 
-    parsed_vulnerabilities = {"npm_audit_vulnerabilities": []}
-
     vulnerabilities = audit_json.get("advisories", {})
-    for _, advisory in vulnerabilities.items():
-        parsed_vulnerabilities["npm_audit_vulnerabilities"].append(
-            {
-                "package": advisory.get("module_name"),
-                "severity": advisory.get("severity"),
-                "title": advisory.get("title"),
-                "url": advisory.get("url"),
-            }
+    advisory_fields = dict.fromkeys(
+        (
+            advisory.get("module_name"),
+            advisory.get("severity"),
+            advisory.get("title"),
+            advisory.get("url"),
         )
+        for advisory in vulnerabilities.values()
+    )
+
+    return {
+        "npm_audit_vulnerabilities": [
+            {"package": package, "severity": severity, "title": title, "url": url}
+            for package, severity, title, url in advisory_fields
+        ]
+    }
+
+
+def audit_dependencies(logger: Logger, dependencies: dict) -> dict:
+    """Runs npm audit analysis of the given dependencies"""
+
+    # Many extensions share the same dependencies, so results are memoized per
+    # process. Failed audits return None and are not memoized
+    dependencies_key = hashlib.blake2b(
+        orjson.dumps(dependencies, option=orjson.OPT_SORT_KEYS)
+    ).hexdigest()
+    if dependencies_key in AUDIT_CACHE:
+        return AUDIT_CACHE[dependencies_key]
+
+    # Scratch space is removed on exit
+    with tempfile.TemporaryDirectory(dir=get_scratch_root()) as packages_folder:
+        create_package_json_file(dependencies, packages_folder)
+        if not install_package_lock_only(logger, packages_folder):
+            return None
+        audit_json = run_npm_audit(logger, packages_folder)
 
-    return parsed_vulnerabilities
+    if audit_json is None:
+        return None
+
+    AUDIT_CACHE[dependencies_key] = parse_audit_result(audit_json)
+    return AUDIT_CACHE[dependencies_key]
 
 
 def upsert_analyses(
     logger: Logger,
     connection: psycopg2.extensions.connection,
     analyses_df: pd.DataFrame,
-    batch_size: int = 5000,
 ) -> None:
-    """Upserts the given analyses to the database in batches"""
-
-    upsert_query = """
-        INSERT INTO analyses (
-            analysis_id, release_id, insertion_date, dependencies, activation_events, semgrep_detections, npm_audit_vulnerabilities
-        ) VALUES %s
-        ON CONFLICT (analysis_id) DO UPDATE SET
-            release_id = EXCLUDED.release_id,
-            insertion_date = EXCLUDED.insertion_date,
-            dependencies = EXCLUDED.dependencies,
-            activation_events = EXCLUDED.activation_events,
-            semgrep_detections = EXCLUDED.semgrep_detections,
-            npm_audit_vulnerabilities = EXCLUDED.npm_audit_vulnerabilities;
-    """
-
-    values = [
-        (
-            row["analysis_id"],
-            row["release_id"],
-            row["insertion_date"],
-            json.dumps(row["dependencies"]),
-            json.dumps(row["activation_events"]),
-            json.dumps(row["semgrep_detections"]),
-            json.dumps(row["npm_audit_vulnerabilities"]),
-        )
-        for _, row in analyses_df.iterrows()
-    ]
+    """Upserts the given analyses to the database"""
 
-    for i in range(0, len(values), batch_size):
-        batch = values[i : i + batch_size]
-        upsert_data(logger, connection, "analyses", upsert_query, batch)
-        logger.info(
-            "upsert_analyses: Upserted analyses batch %d of %d rows",
-            i // batch_size + 1,
-            len(batch),
-        )
+    if analyses_df.empty:
+        logger.info("upsert_analyses: no analyses to upsert")
+        return
+
+    # Serialize each JSONB column in a single pass
+    copy_df = analyses_df[ANALYSES_COLUMNS].assign(
+        **{column: analyses_df[column].map(dumps_json) for column in PAYLOAD_COLUMNS}
+    )
+
+    copy_upsert_data(logger, connection, "analyses", ["analysis_id"], copy_df)
 
 
-def clear_directory(logger: Logger, directory: str = "extensions"):
-    """Deletes the given directory and its contents"""
+def hash_vsix_file(vsix_file: io.BytesIO) -> str:
+    """Computes the SHA-256 hex digest of the in-memory .vsix file"""
 
-    if os.path.exists(directory):
-        for item in os.listdir(directory):
-            item_path = os.path.join(directory, item)
-            if os.path.isfile(item_path) or os.path.islink(item_path):
-                os.unlink(item_path)
-            elif os.path.isdir(item_path):
-                shutil.rmtree(item_path)
-    logger.info("clear_directory: deleted all the contents from %s", directory)
+    with vsix_file.getbuffer() as vsix_bytes:
+        return hashlib.sha256(vsix_bytes).hexdigest()
 
 
-def analyze_extension(logger: Logger, s3_client: BaseClient, row: pd.Series) -> dict:
-    """Performs analysis of the given extension"""
+@functools.lru_cache(maxsize=None)
+def hash_semgrep_config() -> str:
+    """Computes the SHA-256 hex digest of the semgrep rule files"""
 
-    analysis_data = {
-        "analysis_id": "analysis-" + row["release_id"],
-        "release_id": row["release_id"],
+    digest = hashlib.sha256()
+    for folder, subfolders, file_names in os.walk(SEMGREP_CONFIG_FOLDER):
+        subfolders.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(folder, file_name)
+            with open(file_path, "rb") as file:
+                file_bytes = file.read()
+            relative_path = os.path.relpath(file_path, SEMGREP_CONFIG_FOLDER)
+            digest.update(f"{relative_path}\0{len(file_bytes)}\0".encode("utf-8"))
+            digest.update(file_bytes)
+
+    return digest.hexdigest()
+
+
+def extract_payload(analysis_data: dict) -> dict:
+    """Extracts the analysis fields that only depend on the .vsix file contents"""
+
+    return {column: analysis_data[column] for column in PAYLOAD_COLUMNS}
+
+
+def create_analysis_data(row: Release) -> dict:
+    """Creates the identifying fields of the given release's analysis"""
+
+    return {
+        "analysis_id": "analysis-" + row.release_id,
+        "release_id": row.release_id,
         "insertion_date": date.today(),
     }
 
-    publisher_name = row["publisher_name"]
-    extension_name = row["extension_name"]
-    release_version = row["version"]
 
-    # Fetch .vsix file from S3
-    object_key = f"extensions/{publisher_name}/{extension_name}/{release_version}.vsix"
-    download_vsix_file(logger, s3_client, object_key)
-    unzip_vsix_file(logger, object_key)
+def analyze_extension(
+    logger: Logger, row: Release, vsix_file: BinaryIO, source_folder: str
+) -> dict:
+    """Performs package.json analysis of the given extension"""
+
+    analysis_data = create_analysis_data(row)
+
+    # Open the archive once for both the package.json read and the extraction
+    try:
+        with zipfile.ZipFile(vsix_file, "r") as zip_ref:
+            package_json = read_package_json_from_vsix(logger, zip_ref)
+            unzip_vsix_file(logger, zip_ref, source_folder)
+    except zipfile.BadZipFile as err:
+        logger.error(
+            "analyze_extension: invalid .vsix file for release %s - %s",
+            row.release_id,
+            str(err),
+        )
+        shutil.rmtree(source_folder, ignore_errors=True)
+        return None
 
     # package.json analysis
-    package_json = find_package_json(logger, object_key)
-    package_metadata = extract_package_metadata(package_json)
+    package_metadata = extract_package_metadata(package_json or {})
     analysis_data.update(package_metadata)
 
-    # npm audit analysis
-    create_package_json_file(package_metadata["dependencies"])
-    install_package_lock_only(logger)
-    audit_json = run_npm_audit(logger)
-    audit_metadata = parse_audit_result(audit_json)
-    analysis_data.update(audit_metadata)
+    return analysis_data
+
 
-    # semgrep analysis
-    semgrep_output = semgrep_analysis(logger)
-    semgrep_metadata = extract_semgrep_metadata(semgrep_output)
-    analysis_data.update(semgrep_metadata)
+def cache_analyses(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+    analyses: Dict[str, dict],
+) -> None:
+    """Caches the payload of the given analyses"""
+
+    if not analyses:
+        return
+
+    cache_df = pd.DataFrame(
+        {
+            "vsix_sha256": list(analyses.keys()),
+            "rules_sha256": hash_semgrep_config(),
+            "payload": [
+                dumps_json(extract_payload(analysis_data))
+                for analysis_data in analyses.values()
+            ],
+        }
+    )
+    copy_upsert_data(
+        logger, connection, "analysis_cache", ["vsix_sha256", "rules_sha256"], cache_df
+    )
 
-    clear_directory(logger)
 
-    return analysis_data
+def prepare_batch(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+    prefetched: Iterable[Tuple[Release, io.BytesIO]],
+    batch_folder: str,
+) -> Tuple[Dict[str, dict], List[dict], List[Tuple[Release, str]]]:
+    """Extracts the given extensions into the batch folder"""
+
+    analyses = {}
+    cached_analyses = []
+    duplicate_rows = []
+    for row, vsix_file in prefetched:
+        # Byte-identical files reuse the cached results, or within the batch the
+        # results of the first copy once they are available
+        vsix_sha256 = hash_vsix_file(vsix_file)
+        if vsix_sha256 in analyses:
+            duplicate_rows.append((row, vsix_sha256))
+            continue
+
+        payload = select_cached_analysis(
+            logger, connection, vsix_sha256, hash_semgrep_config()
+        )
+        if payload is not None:
+            cached_analyses.append({**create_analysis_data(row), **payload})
+            continue
+
+        # Invalid archives, e.g. truncated downloads, stay pending for the next run
+        source_folder = os.path.join(batch_folder, vsix_sha256)
+        analysis_data = analyze_extension(logger, row, vsix_file, source_folder)
+        if analysis_data is not None:
+            analyses[vsix_sha256] = analysis_data
+
+    return analyses, cached_analyses, duplicate_rows
+
+
+def scan_batch(
+    logger: Logger, batch_folder: str, vsix_sha256s: List[str]
+) -> Tuple[Dict[str, dict], List[str]]:
+    """Scans the extensions in the batch folder using semgrep"""
+
+    semgrep_metadata = semgrep_analysis(logger, batch_folder)
+    if semgrep_metadata is not None:
+        return semgrep_metadata, []
+
+    # Scan each extension on its own so that only those semgrep fails on are lost
+    logger.error(
+        "scan_batch: semgrep failed on the batch, scanning %d extensions one by one",
+        len(vsix_sha256s),
+    )
+    semgrep_metadata = {}
+    failed_vsix_sha256s = []
+    for vsix_sha256 in vsix_sha256s:
+        extension_metadata = semgrep_analysis(logger, batch_folder, [vsix_sha256])
+        if extension_metadata is None:
+            failed_vsix_sha256s.append(vsix_sha256)
+        else:
+            semgrep_metadata.update(extension_metadata)
+
+    return semgrep_metadata, failed_vsix_sha256s
+
+
+def add_audit_results(
+    analyses: Dict[str, dict], audit_futures: Dict[str, Future]
+) -> Dict[str, dict]:
+    """Adds the npm audit results to the given analyses"""
+
+    audited_analyses = {}
+    for vsix_sha256, analysis_data in analyses.items():
+        audit_metadata = audit_futures[vsix_sha256].result()
+        if audit_metadata is not None:
+            audited_analyses[vsix_sha256] = analysis_data
+        analysis_data.update(audit_metadata or parse_audit_result({}))
+
+    return audited_analyses
+
+
+def reuse_analyses(
+    analyses: Dict[str, dict], duplicate_rows: List[Tuple[Release, str]]
+) -> List[dict]:
+    """Creates the analyses of the given releases from those of identical files"""
+
+    return [
+        {**create_analysis_data(row), **extract_payload(analyses[vsix_sha256])}
+        for row, vsix_sha256 in duplicate_rows
+        if vsix_sha256 in analyses
+    ]
+
+
+def analyze_batch(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+    prefetched: Iterable[Tuple[Release, io.BytesIO]],
+) -> List[dict]:
+    """Analyzes a batch of extensions"""
+
+    # One semgrep scan covers the whole batch to amortize its startup cost, while
+    # the npm audits run in background threads
+    with tempfile.TemporaryDirectory(dir=get_scratch_root()) as batch_folder:
+        analyses, cached_analyses, duplicate_rows = prepare_batch(
+            logger, connection, prefetched, batch_folder
+        )
+        if not analyses:
+            return cached_analyses
+
+        with ThreadPoolExecutor(max_workers=AUDIT_WORKERS) as executor:
+            # npm audit analysis
+            audit_futures = {
+                vsix_sha256: executor.submit(
+                    audit_dependencies, logger, analysis_data["dependencies"]
+                )
+                for vsix_sha256, analysis_data in analyses.items()
+            }
+
+            # semgrep analysis
+            semgrep_metadata, failed_vsix_sha256s = scan_batch(
+                logger, batch_folder, list(analyses)
+            )
+
+    # A failed scan says nothing about an extension, so its releases are left
+    # pending for the next run rather than upserted or cached as clean
+    if failed_vsix_sha256s:
+        logger.error(
+            "analyze_batch: semgrep failed, skipping %d extensions of the batch",
+            len(failed_vsix_sha256s),
+        )
+        for vsix_sha256 in failed_vsix_sha256s:
+            del analyses[vsix_sha256]
+
+    # Failed audits are reported as having no vulnerabilities, but aren't cached
+    audited_analyses = add_audit_results(analyses, audit_futures)
+    for vsix_sha256, analysis_data in analyses.items():
+        analysis_data.update(
+            semgrep_metadata.get(vsix_sha256, {"semgrep_detections": []})
+        )
+    cache_analyses(logger, connection, audited_analyses)
+
+    duplicate_analyses = reuse_analyses(analyses, duplicate_rows)
+    return cached_analyses + duplicate_analyses + list(analyses.values())
+
+
+def analyze_partition(rows: List[Release]) -> List[dict]:
+    """Analyzes the given releases in a worker process"""
+
+    # Worker processes set up their own logger and clients
+    logger = configure_logger()
+    connection = connect_to_database(logger)
+    try:
+        prepare_select_cached_analysis(logger, connection)
+        s3_client = boto3.client("s3")
+
+        prefetched = prefetch_vsix_files(logger, s3_client, rows)
+        return analyze_batch(logger, connection, prefetched)
+    finally:
+        release_connection(connection)
 
 
 def main():
@@ -288,27 +657,27 @@ def main():
     logger = configure_logger()
     setup_db(logger)
     connection = connect_to_database(logger)
-    s3_client = boto3.client("s3")
-
-    # Fetch extension data
-    extensions_df = select_extensions(logger, connection)
-    publishers_df = select_publishers(logger, connection)
-    releases_df = select_releases(logger, connection)
-    combined_df = combine_dataframes(
-        [releases_df, extensions_df, publishers_df], ["extension_id", "publisher_id"]
-    )
 
-    # Fetch existing analyses
-    analyses_df = select_analyses(logger, connection)
-    analyzed_release_ids = set(analyses_df["release_id"])
+    # Fetch the releases uploaded to S3 that haven't been analyzed before
+    pending_df = select_pending_releases(logger, connection)
+    pending_rows = [
+        Release(*row)
+        for row in pending_df[list(Release._fields)].itertuples(index=False)
+    ]
 
-    # Analyze extension
+    # Analyze semgrep-sized batches in parallel worker processes. Workers are
+    # spawned rather than forked since boto3 clients and database connections
+    # are not fork-safe
+    partitions = [
+        pending_rows[i : i + SEMGREP_BATCH_SIZE]
+        for i in range(0, len(pending_rows), SEMGREP_BATCH_SIZE)
+    ]
     analysis_metadata = []
-    for _, row in combined_df.iterrows():
-        # Ensure the release is uploaded to S3 and hasn't been analyzed before
-        if row["uploaded_to_s3"] and row["release_id"] not in analyzed_release_ids:
-            analysis = analyze_extension(logger, s3_client, row)
-            analysis_metadata.append(analysis)
+    with ProcessPoolExecutor(
+        max_workers=ANALYSIS_PROCESSES, mp_context=multiprocessing.get_context("spawn")
+    ) as executor:
+        for partition_analyses in executor.map(analyze_partition, partitions):
+            analysis_metadata.extend(partition_analyses)
 
     # Upsert analyses
     new_analyses = pd.DataFrame(analysis_metadata)
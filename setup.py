@@ -5,7 +5,7 @@ import logging
 from logging import Logger
 import psycopg2
 
-from util import connect_to_database
+from util import connect_to_database, release_connection
 
 CREATE_ANALYSES_TABLE_QUERY = """
     CREATE TABLE IF NOT EXISTS analyses (
@@ -20,6 +20,20 @@ CREATE_ANALYSES_TABLE_QUERY = """
     );
 """
 
+CREATE_ANALYSIS_CACHE_TABLE_QUERY = """
+    CREATE TABLE IF NOT EXISTS analysis_cache (
+        vsix_sha256 CHAR(64) NOT NULL,
+        rules_sha256 CHAR(64) NOT NULL,
+        payload JSONB NOT NULL,
+        PRIMARY KEY (vsix_sha256, rules_sha256)
+    );
+"""
+
+# Backs the anti-join in select_pending_releases and the cascade from releases
+CREATE_ANALYSES_RELEASE_ID_INDEX_QUERY = """
+    CREATE INDEX IF NOT EXISTS idx_analyses_release_id ON analyses (release_id);
+"""
+
 
 def create_table(
     logger: Logger,
@@ -44,12 +58,44 @@ def create_table(
     logger.info("create_table: Created %s table", table_name)
 
 
+def create_index(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+    index_name: str,
+    create_index_query: str,
+) -> None:
+    """Executes the create index query for the given index"""
+
+    if connection is None:
+        logger.error(
+            "create_index: Failed to create %s index: no database connection",
+            index_name,
+        )
+        return
+
+    cursor = connection.cursor()
+    cursor.execute(create_index_query)
+    connection.commit()
+    cursor.close()
+
+    logger.info("create_index: Created %s index", index_name)
+
+
 def setup_db(logger: Logger) -> None:
-    """Creates the analyses table"""
+    """Creates the analyses and analysis cache tables"""
 
     connection = connect_to_database(logger)
     create_table(logger, connection, "analyses", CREATE_ANALYSES_TABLE_QUERY)
-    connection.close()
+    create_table(
+        logger, connection, "analysis_cache", CREATE_ANALYSIS_CACHE_TABLE_QUERY
+    )
+    create_index(
+        logger,
+        connection,
+        "idx_analyses_release_id",
+        CREATE_ANALYSES_RELEASE_ID_INDEX_QUERY,
+    )
+    release_connection(connection)
 
 
 def configure_logger() -> Logger:
@@ -1,17 +1,35 @@
 """Contains helper functions"""
 
+import io
 import os
-from typing import List
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Tuple
 from logging import Logger
 import psycopg2
 from psycopg2.extras import execute_values
+from psycopg2.pool import ThreadedConnectionPool
 import pandas as pd
+import pyarrow as pa
+from pyarrow import csv as pa_csv
 
+# Arrow types of the PostgreSQL column types, by type OID, that pyarrow decodes
+# natively from CSV. Other columns are read as strings
+ARROW_COLUMN_TYPES = {
+    16: pa.bool_(),  # boolean
+    20: pa.int64(),  # bigint
+    21: pa.int16(),  # smallint
+    23: pa.int32(),  # integer
+}
 
-def connect_to_database(logger: Logger) -> psycopg2.extensions.connection:
-    """Establishes a connection to the SQL database"""
 
-    connection = psycopg2.connect(
+@functools.lru_cache(maxsize=None)
+def get_connection_pool() -> ThreadedConnectionPool:
+    """Creates the process-wide pool of SQL database connections on first use"""
+
+    return ThreadedConnectionPool(
+        minconn=1,
+        maxconn=int(os.getenv("PG_POOL_SIZE", "25")),
         dbname=os.getenv("PG_DATABASE"),
         user=os.getenv("PG_USER"),
         password=os.getenv("PG_PASSWORD"),
@@ -19,6 +37,12 @@ def connect_to_database(logger: Logger) -> psycopg2.extensions.connection:
         port=os.getenv("PG_PORT"),
     )
 
+
+def connect_to_database(logger: Logger) -> psycopg2.extensions.connection:
+    """Borrows a connection to the SQL database from the connection pool"""
+
+    connection = get_connection_pool().getconn()
+
     if connection:
         logger.info(
             "connect_to_database: Connected to database %s on host %s:%s",
@@ -36,43 +60,214 @@ def connect_to_database(logger: Logger) -> psycopg2.extensions.connection:
     return None
 
 
-def upsert_data(
+def release_connection(connection: psycopg2.extensions.connection) -> None:
+    """Returns the given connection to the connection pool"""
+
+    get_connection_pool().putconn(connection)
+
+
+def insert_data(
     logger: Logger,
     connection: psycopg2.extensions.connection,
     table_name: str,
-    upsert_data_query: str,
+    columns: List[str],
     data: list,
 ) -> None:
-    """Executes the upsert data query with the given data on the given table"""
+    """Inserts the given rows into the given columns of the table"""
+
+    insert_data_query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s"
 
+    # execute_values sends 1000 rows per INSERT; prefer copy_upsert_data for large loads
     cursor = connection.cursor()
-    execute_values(cursor, upsert_data_query, data)
+    execute_values(cursor, insert_data_query, data, page_size=1000)
     connection.commit()
     cursor.close()
 
     logger.info(
-        "upsert_data: Upserted %d rows of %s data to the database",
+        "insert_data: Inserted %d rows of %s data to the database",
         len(data),
         table_name,
     )
 
 
+def format_copy_value(value) -> str:
+    """Formats the given value as a field of PostgreSQL's COPY text format"""
+
+    if value is None:
+        return "\\N"
+
+    return (
+        str(value)
+        .replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def copy_upsert_data(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+    table_name: str,
+    conflict_columns: List[str],
+    data_df: pd.DataFrame,
+) -> None:
+    """Upserts the given data into the given table through a staging table"""
+
+    stage_table_name = f"{table_name}_stage"
+    column_list = ", ".join(data_df.columns)
+    update_list = ", ".join(
+        f"{column} = EXCLUDED.{column}"
+        for column in data_df.columns
+        if column not in conflict_columns
+    )
+
+    create_stage_query = f"""
+        CREATE TEMP TABLE {stage_table_name}
+            (LIKE {table_name} INCLUDING DEFAULTS) ON COMMIT DROP;
+    """
+    copy_query = f"COPY {stage_table_name} ({column_list}) FROM STDIN"
+    upsert_query = f"""
+        INSERT INTO {table_name} ({column_list})
+        SELECT {column_list} FROM {stage_table_name}
+        ON CONFLICT ({', '.join(conflict_columns)}) DO UPDATE SET {update_list};
+    """
+
+    # Build the COPY payload column-wise, without materializing a row per Series
+    buffer = io.StringIO()
+    columns = [data_df[column].to_numpy() for column in data_df.columns]
+    for row in zip(*columns):
+        buffer.write("\t".join(format_copy_value(value) for value in row) + "\n")
+    buffer.seek(0)
+
+    cursor = connection.cursor()
+    cursor.execute(create_stage_query)
+    cursor.copy_expert(copy_query, buffer)
+    cursor.execute(upsert_query)
+    connection.commit()
+    cursor.close()
+
+    logger.info(
+        "copy_upsert_data: Upserted %d rows of %s data to the database",
+        len(data_df),
+        table_name,
+    )
+
+
+def fetch_row_chunks(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+    table_name: str,
+    select_data_query: str,
+    chunk_size: int,
+) -> Iterator[Tuple[List[str], List[tuple]]]:
+    """Yields the column names and each chunk of rows of the select data query"""
+
+    # A server-side cursor holds at most chunk_size rows on the client at a time
+    with connection.cursor(name=f"stream_{table_name}") as cursor:
+        cursor.itersize = chunk_size
+        cursor.execute(select_data_query)
+
+        # The first chunk is yielded even when empty so callers still see the columns
+        rows = cursor.fetchmany(chunk_size)
+        columns = [column.name for column in cursor.description]
+        while True:
+            logger.info(
+                "select_data: Processed chunk of %s with %d rows", table_name, len(rows)
+            )
+            yield columns, rows
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+
+
+def select_data_iter(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+    table_name: str,
+    select_data_query: str,
+    chunk_size: int = 10000,
+) -> Iterator[pd.DataFrame]:
+    """Executes the select data query on the given table, one DataFrame per chunk"""
+
+    for columns, rows in fetch_row_chunks(
+        logger, connection, table_name, select_data_query, chunk_size
+    ):
+        yield pd.DataFrame(rows, columns=columns)
+
+
 def select_data(
     logger: Logger,
     connection: psycopg2.extensions.connection,
     table_name: str,
     select_data_query: str,
+    chunk_size: int = 10000,
 ) -> pd.DataFrame:
     """Executes the select data query on the given table"""
 
-    chunks = []
-    for chunk in pd.read_sql_query(select_data_query, connection, chunksize=10000):
-        chunks.append(chunk)
-        logger.info(
-            "select_data: Processed chunk of %s with %d rows", table_name, len(chunk)
-        )
+    # Append each chunk to per-column lists so the DataFrame is built once, rather
+    # than building one per chunk and copying them all in pd.concat
+    columns, column_values = [], []
+    for columns, rows in fetch_row_chunks(
+        logger, connection, table_name, select_data_query, chunk_size
+    ):
+        column_values = column_values or [[] for _ in columns]
+        for values, chunk_values in zip(column_values, zip(*rows)):
+            values.extend(chunk_values)
 
-    return pd.concat(chunks, ignore_index=True)
+    return pd.DataFrame(dict(zip(columns, column_values)), columns=columns)
+
+
+def select_data_arrow(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+    table_name: str,
+    select_data_query: str,
+    column_types: Dict[str, pa.DataType] = None,
+) -> pd.DataFrame:
+    """Executes the select data query on the given table through COPY"""
+
+    query = select_data_query.strip().rstrip(";")
+    describe_query = f"SELECT * FROM ({query}) AS result LIMIT 0"
+    copy_query = f"COPY ({query}) TO STDOUT WITH (FORMAT CSV, HEADER)"
+
+    # The whole result is held in memory, unlike select_data's server-side cursor
+    buffer = io.BytesIO()
+    cursor = connection.cursor()
+    cursor.execute(describe_query)
+    column_descriptions = cursor.description
+    cursor.copy_expert(copy_query, buffer)
+    cursor.close()
+    buffer.seek(0)
+
+    # Take column types from PostgreSQL rather than letting pyarrow infer them, e.g.
+    # a "1.10" version must stay a string while integer IDs are decoded natively
+    arrow_column_types = {
+        column.name: ARROW_COLUMN_TYPES.get(column.type_code, pa.string())
+        for column in column_descriptions
+    }
+    arrow_column_types.update(column_types or {})
+    convert_options = pa_csv.ConvertOptions(
+        column_types=arrow_column_types,
+        # PostgreSQL writes NULL as an unquoted empty field and quotes empty strings,
+        # so only that is a null; names such as "NA" or "null" are kept as is
+        null_values=[""],
+        strings_can_be_null=True,
+        quoted_strings_can_be_null=False,
+        # PostgreSQL writes booleans as t/f
+        true_values=["t"],
+        false_values=["f"],
+    )
+    # PostgreSQL quotes values that contain newlines rather than escaping them
+    parse_options = pa_csv.ParseOptions(newlines_in_values=True)
+    table = pa_csv.read_csv(
+        buffer, parse_options=parse_options, convert_options=convert_options
+    )
+
+    logger.info(
+        "select_data_arrow: Processed %s with %d rows", table_name, table.num_rows
+    )
+    return table.to_pandas(types_mapper=pd.ArrowDtype)
 
 
 def select_extensions(
@@ -89,7 +284,7 @@ def select_extensions(
         FROM
             extensions;
     """
-    return select_data(logger, connection, "extensions", query)
+    return select_data_arrow(logger, connection, "extensions", query)
 
 
 def select_publishers(
@@ -105,7 +300,7 @@ def select_publishers(
         FROM
             publishers;
     """
-    return select_data(logger, connection, "publishers", query)
+    return select_data_arrow(logger, connection, "publishers", query)
 
 
 def select_releases(
@@ -123,7 +318,7 @@ def select_releases(
         FROM
             releases;
     """
-    return select_data(logger, connection, "releases", query)
+    return select_data_arrow(logger, connection, "releases", query)
 
 
 def select_analyses(
@@ -138,11 +333,130 @@ def select_analyses(
         FROM
             analyses;
     """
-    return select_data(logger, connection, "analyses", query)
+    return select_data_arrow(logger, connection, "analyses", query)
+
+
+def select_with_pooled_connection(
+    logger: Logger,
+    select_function: Callable[[Logger, psycopg2.extensions.connection], pd.DataFrame],
+) -> pd.DataFrame:
+    """Runs the given select_* function on its own pooled connection"""
+
+    connection = connect_to_database(logger)
+    try:
+        return select_function(logger, connection)
+    finally:
+        release_connection(connection)
+
+
+def select_all(logger: Logger) -> Dict[str, pd.DataFrame]:
+    """Retrieves all extensions, publishers, releases and analyses concurrently"""
+
+    select_functions = {
+        "extensions": select_extensions,
+        "publishers": select_publishers,
+        "releases": select_releases,
+        "analyses": select_analyses,
+    }
+
+    # Each select runs on its own pooled connection so the round trips overlap
+    with ThreadPoolExecutor(max_workers=len(select_functions)) as executor:
+        futures = {
+            table_name: executor.submit(
+                select_with_pooled_connection, logger, select_function
+            )
+            for table_name, select_function in select_functions.items()
+        }
+
+    return {table_name: future.result() for table_name, future in futures.items()}
+
+
+def select_pending_releases(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+) -> pd.DataFrame:
+    """Retrieves the releases uploaded to S3 that haven't been analyzed yet"""
+
+    query = """
+        SELECT
+            r.release_id,
+            p.publisher_name,
+            e.extension_name,
+            r.version
+        FROM
+            releases r
+            JOIN extensions e USING (extension_id)
+            JOIN publishers p USING (publisher_id)
+            LEFT JOIN analyses a USING (release_id)
+        WHERE
+            r.uploaded_to_s3
+            AND a.release_id IS NULL;
+    """
+    return select_data_arrow(logger, connection, "pending_releases", query)
+
+
+def prepare_select_cached_analysis(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+) -> None:
+    """Prepares the cached analysis lookup for the given connection"""
+
+    prepared_query = """
+        SELECT
+            1
+        FROM
+            pg_prepared_statements
+        WHERE
+            name = 'select_cached_analysis';
+    """
+    query = """
+        PREPARE select_cached_analysis (CHAR(64), CHAR(64)) AS
+        SELECT
+            payload
+        FROM
+            analysis_cache
+        WHERE
+            vsix_sha256 = $1
+            AND rules_sha256 = $2;
+    """
+
+    # Pooled connections may already have prepared it for a previous batch
+    cursor = connection.cursor()
+    cursor.execute(prepared_query)
+    if cursor.fetchone() is None:
+        cursor.execute(query)
+        logger.info("prepare_select_cached_analysis: Prepared cached analysis lookup")
+    connection.commit()
+    cursor.close()
+
+
+def select_cached_analysis(
+    logger: Logger,
+    connection: psycopg2.extensions.connection,
+    vsix_sha256: str,
+    rules_sha256: str,
+) -> dict:
+    """Retrieves the cached analysis payload of the given .vsix file"""
+
+    cursor = connection.cursor()
+    cursor.execute(
+        "EXECUTE select_cached_analysis (%s, %s);", (vsix_sha256, rules_sha256)
+    )
+    row = cursor.fetchone()
+    cursor.close()
+
+    if row is None:
+        return None
+
+    logger.info("select_cached_analysis: Found cached analysis for %s", vsix_sha256)
+    return row[0]
 
 
 def combine_dataframes(
-    dataframes: List[pd.DataFrame], keys: List[str], how: str = "inner"
+    dataframes: List[pd.DataFrame],
+    keys: List[str],
+    how: str = "inner",
+    validate: List[str] = None,
 ) -> pd.DataFrame:
     """Generic function to merge multiple dataframes based on the specified keys"""
 
@@ -151,8 +465,19 @@ def combine_dataframes(
             "Number of keys must be one less than the number of dataframes."
         )
 
-    combined_df = dataframes[0]
-    for i, key in enumerate(keys):
-        combined_df = combined_df.merge(dataframes[i + 1], on=key, how=how)
+    if validate is None:
+        validate = [None] * len(keys)
+    elif len(validate) != len(keys):
+        raise ValueError("Number of validate checks must match the number of keys.")
+
+    # Copy-on-write lets each intermediate result share the blocks it doesn't
+    # modify instead of copying them. The result is copied once at the end, since
+    # outside copy-on-write writes to shared blocks would reach the inputs
+    with pd.option_context("mode.copy_on_write", True):
+        combined_df = dataframes[0]
+        for key, right_df, key_validate in zip(keys, dataframes[1:], validate):
+            combined_df = combined_df.merge(
+                right_df, on=key, how=how, sort=False, validate=key_validate
+            )
 
-    return combined_df
+    return combined_df.copy()